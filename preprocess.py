@@ -207,6 +207,7 @@ def main():
     parser.add_argument('-share_vocab', action='store_true')
     parser.add_argument('-vocab', default=None)
     parser.add_argument('-use_glove_emb', action='store_true')
+    parser.add_argument('-glove_workers', type=int, default=1)
 
     opt = parser.parse_args()
     opt.max_token_subseq_len = opt.max_subseq_len + 2 # include the <s> and </s>
@@ -269,13 +270,13 @@ def main():
 
     #- Generate glove embedding tables if using them
     if opt.use_glove_emb:
-        src_word2idx, src_emb_table = create_glove_emb_table(src_word2idx, 'src')
+        src_word2idx, src_emb_table = create_glove_emb_table(src_word2idx, 'src', n_workers=opt.glove_workers)
         np.save('data/glove/src_emb_file.npy', src_emb_table)
         if opt.share_vocab:
             tgt_word2idx = src_word2idx
             tgt_emb_table = src_emb_table
         else:
-            tgt_word2idx, tgt_emb_table = create_glove_emb_table(tgt_word2idx, 'tgt')
+            tgt_word2idx, tgt_emb_table = create_glove_emb_table(tgt_word2idx, 'tgt', n_workers=opt.glove_workers)
         np.save('data/glove/tgt_emb_file.npy', tgt_emb_table)
 
     #- Map word to index
@@ -15,13 +15,13 @@ class EncoderLayer(nn.Module):
             n_head, d_model, d_k, d_v, dropout=dropout)
         self.pos_ffn = PositionwiseFeedForward(d_model, d_inner, dropout=dropout)
 
-    def forward(self, enc_input, non_pad_mask=None, slf_attn_mask=None):
+    def forward(self, enc_input, non_pad_mask=None, slf_attn_mask=None, need_weights=False):
         enc_output, enc_slf_attn = self.slf_attn(
-            enc_input, enc_input, enc_input, mask=slf_attn_mask)
-        enc_output *= non_pad_mask
+            enc_input, enc_input, enc_input, mask=slf_attn_mask, need_weights=need_weights)
+        enc_output = enc_output.masked_fill(~non_pad_mask, 0.)
 
         enc_output = self.pos_ffn(enc_output)
-        enc_output *= non_pad_mask
+        enc_output = enc_output.masked_fill(~non_pad_mask, 0.)
 
         return enc_output, enc_slf_attn
 
@@ -56,16 +56,19 @@ class DecoderLayer(nn.Module):
         self.enc_attn = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout)
         self.pos_ffn = PositionwiseFeedForward(d_model, d_inner, dropout=dropout)
 
-    def forward(self, dec_input, enc_output, non_pad_mask=None, slf_attn_mask=None, dec_enc_attn_mask=None):
+    def forward(
+            self, dec_input, enc_output, non_pad_mask=None, slf_attn_mask=None, dec_enc_attn_mask=None,
+            slf_attn_causal=False, need_weights=False):
         dec_output, dec_slf_attn = self.slf_attn(
-            dec_input, dec_input, dec_input, mask=slf_attn_mask)
-        dec_output *= non_pad_mask
+            dec_input, dec_input, dec_input, mask=slf_attn_mask,
+            is_causal=slf_attn_causal, need_weights=need_weights)
+        dec_output = dec_output.masked_fill(~non_pad_mask, 0.)
 
         dec_output, dec_enc_attn = self.enc_attn(
-            dec_output, enc_output, enc_output, mask=dec_enc_attn_mask)
-        dec_output *= non_pad_mask
+            dec_output, enc_output, enc_output, mask=dec_enc_attn_mask, need_weights=need_weights)
+        dec_output = dec_output.masked_fill(~non_pad_mask, 0.)
 
         dec_output = self.pos_ffn(dec_output)
-        dec_output *= non_pad_mask
+        dec_output = dec_output.masked_fill(~non_pad_mask, 0.)
 
         return dec_output, dec_slf_attn, dec_enc_attn
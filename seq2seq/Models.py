@@ -1,6 +1,8 @@
 ''' Define the Seq2Seq model '''
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 from seq2seq import Constants
@@ -9,51 +11,64 @@ from seq2seq.Layers import EncoderLayer, DecoderLayer, AttentionLayer
 
 def get_non_pad_mask(seq):
     assert seq.dim() == 2
-    return seq.ne(Constants.PAD).type(torch.float).unsqueeze(-1)
+    return seq.ne(Constants.PAD).unsqueeze(-1)  # b x l x 1
 
-def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None):
+def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None, device=None):
     ''' Sinusoid position encoding table '''
-    def cal_angle(position, hid_idx):
-        return position / np.power(10000, 2 * (hid_idx // 2) / d_hid)
+    position = torch.arange(n_position, dtype=torch.float, device=device).unsqueeze(1)
+    div_term = torch.exp(
+        torch.arange(0, d_hid, 2, dtype=torch.float, device=device) * -(math.log(10000.0) / d_hid))
 
-    def get_posi_angle_vec(position):
-        return [cal_angle(position, hid_j) for hid_j in range(d_hid)]
-
-    sinusoid_table = np.array([get_posi_angle_vec(pos_i) for pos_i in range(n_position)])
-
-    sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
-    sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
+    sinusoid_table = torch.zeros(n_position, d_hid, device=device)
+    sinusoid_table[:, 0::2] = torch.sin(position * div_term)  # dim 2i
+    sinusoid_table[:, 1::2] = torch.cos(position * div_term)[:, :d_hid // 2]  # dim 2i+1
 
     if padding_idx is not None:
         #- Zero vector for padding dimension
         sinusoid_table[padding_idx] = 0.
 
-    return torch.FloatTensor(sinusoid_table)
+    return sinusoid_table
 
-def get_attn_key_pad_mask(seq_k, seq_q):
+def get_attn_key_pad_mask(seq_k):
     ''' For masking out the padding part of key sequence. '''
-    #- Expand to fit the shape of key query attention matrix
-    len_q = seq_q.size(1)
-    padding_mask = seq_k.eq(Constants.PAD)
-    padding_mask = padding_mask.unsqueeze(1).expand(-1, len_q, -1)  # b x lq x lk
+    #- Broadcasts over the query dimension of the attention matrix
+    padding_mask = seq_k.eq(Constants.PAD).unsqueeze(1)  # b x 1 x lk
 
     return padding_mask
 
-def get_subsequent_mask(seq):
-    ''' For masking out the subsequent info. '''
+def get_pos_seq(seq, pos_ids):
+    ''' Derive position indices from a cached arange, with 0 at padding '''
     sz_b, len_s = seq.size()
-    subsequent_mask = torch.triu(
-        torch.ones((len_s, len_s), device=seq.device, dtype=torch.uint8), diagonal=1)
-    subsequent_mask = subsequent_mask.unsqueeze(0).expand(sz_b, -1, -1)  # b x ls x ls
+    return pos_ids[:len_s].unsqueeze(0).expand(sz_b, -1).masked_fill(seq.eq(Constants.PAD), 0)
+
+def drop_legacy_position_enc(state_dict, prefix, *args):
+    ''' Drop the position table saved by older checkpoints '''
+    #- The table is a deterministic constant and is rebuilt at init instead of loaded
+    state_dict.pop(prefix + 'position_enc.weight', None)
+    state_dict.pop(prefix + 'position_enc_weight', None)
+
+class PositionEncoding(nn.Module):
+    ''' Fixed sinusoid position table, meant to be shared between modules '''
+
+    def __init__(self, n_position, d_word_vec):
+        super().__init__()
+        self.register_buffer(
+            'weight',
+            get_sinusoid_encoding_table(n_position, d_word_vec, padding_idx=0),
+            persistent=False)
 
-    return subsequent_mask
+    def forward(self, pos):
+        return F.embedding(pos, self.weight)
 
-def get_pretrained_emb(path):
+def get_pretrained_emb(path, freeze=False):
     ''' Load pretrained embedding table from Numpy binary '''
-    emb = np.load(path)
+    #- Frozen tables are memory-mapped (copy-on-write) so that pages are only read on demand
+    emb = np.load(path, mmap_mode='c' if freeze else None)
     assert isinstance(emb, np.ndarray), \
         'Embedding table must be Numpy binary'
-    return torch.FloatTensor(emb)
+    #- Zero-copy view when the table is already stored as contiguous float32
+    emb = np.ascontiguousarray(emb.astype(np.float32, copy=False))
+    return torch.from_numpy(emb)
 
 class Encoder(nn.Module):
     ''' A encoder model with self attention mechanism '''
@@ -63,7 +78,7 @@ class Encoder(nn.Module):
             n_src_vocab, len_max_seq, d_word_vec,
             n_layers, n_head, d_k, d_v,
             d_model, d_inner, dropout=0.1,
-            emb_file=''):
+            emb_file='', freeze_emb=False, position_enc=None):
 
         super().__init__()
 
@@ -72,40 +87,67 @@ class Encoder(nn.Module):
         #- Load static embeddings only if specified
         if emb_file != '':
             self.src_word_emb = nn.Embedding.from_pretrained(
-                get_pretrained_emb(emb_file), freeze=False)
+                get_pretrained_emb(emb_file, freeze_emb), freeze=freeze_emb)
         else:
             self.src_word_emb = nn.Embedding(
                 n_src_vocab, d_word_vec, padding_idx=Constants.PAD)
 
-        self.position_enc = nn.Embedding.from_pretrained(
-            get_sinusoid_encoding_table(n_position, d_word_vec, padding_idx=0),
-            freeze=True)
+        #- Fixed position table; when passed in, the same submodule (and buffer) is shared with
+        #- its other owner, so a device/dtype move of either owner moves the one table
+        if position_enc is None:
+            position_enc = PositionEncoding(n_position, d_word_vec)
+        self.position_enc = position_enc
+        self._register_load_state_dict_pre_hook(drop_legacy_position_enc)
+        self.register_buffer('_pos_ids', torch.arange(1, n_position), persistent=False)
 
         self.layer_stack = nn.ModuleList([
             EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
 
-    def forward(self, src_seq, src_pos, return_attns=False):
-        enc_slf_attn_list = []
+    def forward(self, src_seq, src_pos=None, return_attns=False):
+        if return_attns:
+            return self._forward_debug(src_seq, src_pos)
+        return self._forward_train(src_seq, src_pos),
+
+    def _prepare_input(self, src_seq, src_pos):
+        ''' Embed the source and build the masks '''
+        if src_pos is None:
+            src_pos = get_pos_seq(src_seq, self._pos_ids)
 
         #- Prepare masks
-        slf_attn_mask = get_attn_key_pad_mask(seq_k=src_seq, seq_q=src_seq)
+        slf_attn_mask = get_attn_key_pad_mask(seq_k=src_seq)
         non_pad_mask = get_non_pad_mask(src_seq)
 
-        #- Forward
-        enc_output = self.src_word_emb(src_seq) + self.position_enc(src_pos)
+        enc_input = self.src_word_emb(src_seq) + self.position_enc(src_pos)
+
+        return enc_input, (non_pad_mask, slf_attn_mask)
+
+    def _forward_train(self, src_seq, src_pos):
+        ''' Forward pass without attention weights, free of Python control flow for torch.compile '''
+        enc_output, (non_pad_mask, slf_attn_mask) = self._prepare_input(src_seq, src_pos)
 
         for enc_layer in self.layer_stack:
-            enc_output, enc_slf_attn = enc_layer(
+            enc_output, _ = enc_layer(
                 enc_output,
                 non_pad_mask=non_pad_mask,
                 slf_attn_mask=slf_attn_mask)
-            if return_attns:
-                enc_slf_attn_list += [enc_slf_attn]
 
-        if return_attns:
-            return enc_output, enc_slf_attn_list
-        return enc_output,
+        return enc_output
+
+    def _forward_debug(self, src_seq, src_pos):
+        ''' Forward pass that also collects the self attention weights '''
+        enc_slf_attn_list = []
+        enc_output, (non_pad_mask, slf_attn_mask) = self._prepare_input(src_seq, src_pos)
+
+        for enc_layer in self.layer_stack:
+            enc_output, enc_slf_attn = enc_layer(
+                enc_output,
+                non_pad_mask=non_pad_mask,
+                slf_attn_mask=slf_attn_mask,
+                need_weights=True)
+            enc_slf_attn_list += [enc_slf_attn]
+
+        return enc_output, enc_slf_attn_list
 
 class Session(nn.Module):
     def __init__(self, d_model, d_hidden, dropout=0.1):
@@ -121,18 +163,16 @@ class Session(nn.Module):
         self.c = torch.zeros(batch_size, self.d_hidden).to(device)
 
     def forward(self, enc_output, src_seq, return_attns=False):
-        #- Prepare mask
+        #- Prepare mask (padding rows of enc_output are already zeroed by the encoder layers)
         non_pad_mask = get_non_pad_mask(src_seq)
-        non_pad_mask = non_pad_mask.repeat(1, 1, enc_output.size(-1))
-        enc_output *= non_pad_mask
-        non_pad_mask = non_pad_mask.byte()
 
-        #- Extract features
-        features = enc_output
-        features, _ = torch.max(features, dim=1)
+        #- Extract features, max-pooling over real tokens only
+        features = enc_output.masked_fill(~non_pad_mask, float('-inf')).amax(dim=1)
 
         #- Compute attention with global context
-        self.h, self.c = self.memory(features, (self.h, self.c))
+        #- Keep the recurrent state in FP32 across discourse turns, even under autocast
+        with torch.autocast(device_type=features.device.type, enabled=False):
+            self.h, self.c = self.memory(features.float(), (self.h, self.c))
         ses_output, ses_attn_distr = self.attn(enc_output, self.h, non_pad_mask)
         ses_output = self.layer_norm(ses_output + enc_output)
 
@@ -144,12 +184,15 @@ class Session(nn.Module):
 class Decoder(nn.Module):
     ''' A decoder model with self attention mechanism '''
 
+    #- Debug check that targets are right-padded (syncs with the device, so off by default)
+    check_padding = False
+
     def __init__(
             self,
             n_tgt_vocab, len_max_seq, d_word_vec,
             n_layers, n_head, d_k, d_v,
             d_model, d_inner, dropout=0.1,
-            emb_file=''):
+            emb_file='', freeze_emb=False, position_enc=None):
 
         super().__init__()
         n_position = len_max_seq + 1
@@ -157,48 +200,102 @@ class Decoder(nn.Module):
         #- Load static embeddings only if specified
         if emb_file != '':
             self.tgt_word_emb = nn.Embedding.from_pretrained(
-                get_pretrained_emb(emb_file), freeze=False)
+                get_pretrained_emb(emb_file, freeze_emb), freeze=freeze_emb)
         else:
             self.tgt_word_emb = nn.Embedding(
                 n_tgt_vocab, d_word_vec, padding_idx=Constants.PAD)
 
-        self.position_enc = nn.Embedding.from_pretrained(
-            get_sinusoid_encoding_table(n_position, d_word_vec, padding_idx=0),
-            freeze=True)
+        #- Fixed position table; when passed in, the same submodule (and buffer) is shared with
+        #- its other owner, so a device/dtype move of either owner moves the one table
+        if position_enc is None:
+            position_enc = PositionEncoding(n_position, d_word_vec)
+        self.position_enc = position_enc
+        self._register_load_state_dict_pre_hook(drop_legacy_position_enc)
+        self.register_buffer('_pos_ids', torch.arange(1, n_position), persistent=False)
+
+        #- Subsequent mask for the longest sequence, sliced per forward
+        self.register_buffer(
+            '_causal',
+            torch.triu(torch.ones((n_position, n_position), dtype=torch.bool), diagonal=1),
+            persistent=False)
 
         self.layer_stack = nn.ModuleList([
             DecoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
 
     def forward(self, tgt_seq, tgt_pos, src_seq, enc_output, return_attns=False):
-        dec_slf_attn_list, dec_enc_attn_list = [], []
+        ''' Decode tgt_seq against enc_output.
+
+        tgt_seq must be right-padded (as built by collate_fn): unless return_attns is set,
+        self attention only applies a causal mask and no target key-pad mask, which is
+        equivalent only when no padding precedes a real token. Set check_padding to assert it.
+        '''
+        dec_input, masks = self._prepare_input(tgt_seq, tgt_pos, src_seq, return_attns)
+        return self._forward_from_emb(dec_input, enc_output, masks, return_attns)
+
+    def _prepare_input(self, tgt_seq, tgt_pos, src_seq, return_attns=False):
+        ''' Embed the target and build the masks, reusable across encoder contexts '''
+        if self.check_padding:
+            assert not (tgt_seq[:, :-1].eq(Constants.PAD) & tgt_seq[:, 1:].ne(Constants.PAD)).any(), \
+                'Target sequences must be right-padded.'
+
+        if tgt_pos is None:
+            tgt_pos = get_pos_seq(tgt_seq, self._pos_ids)
 
         #- Prepare masks
         non_pad_mask = get_non_pad_mask(tgt_seq)
 
-        slf_attn_mask_subseq = get_subsequent_mask(tgt_seq)
-        slf_attn_mask_keypad = get_attn_key_pad_mask(seq_k=tgt_seq, seq_q=tgt_seq)
-        slf_attn_mask = (slf_attn_mask_keypad + slf_attn_mask_subseq).gt(0)
+        if return_attns:
+            len_s = tgt_seq.size(1)
+            slf_attn_mask_subseq = self._causal[:len_s, :len_s].unsqueeze(0)  # 1 x ls x ls
+            slf_attn_mask_keypad = get_attn_key_pad_mask(seq_k=tgt_seq)
+            slf_attn_mask = slf_attn_mask_keypad | slf_attn_mask_subseq
+        else:
+            #- Targets are right-padded (see forward), so the causal mask alone hides padding from real tokens
+            slf_attn_mask = None
+
+        dec_enc_attn_mask = get_attn_key_pad_mask(seq_k=src_seq)
+
+        dec_input = self.tgt_word_emb(tgt_seq) + self.position_enc(tgt_pos)
+
+        return dec_input, (non_pad_mask, slf_attn_mask, dec_enc_attn_mask)
+
+    def _forward_from_emb(self, dec_input, enc_output, masks, return_attns=False):
+        if return_attns:
+            return self._forward_debug(dec_input, enc_output, masks)
+        return self._forward_train(dec_input, enc_output, masks),
+
+    def _forward_train(self, dec_input, enc_output, masks):
+        ''' Forward pass without attention weights, free of Python control flow for torch.compile '''
+        non_pad_mask, _, dec_enc_attn_mask = masks
+        dec_output = dec_input
 
-        dec_enc_attn_mask = get_attn_key_pad_mask(seq_k=src_seq, seq_q=tgt_seq)
+        for dec_layer in self.layer_stack:
+            dec_output, _, _ = dec_layer(
+                dec_output, enc_output,
+                non_pad_mask=non_pad_mask,
+                dec_enc_attn_mask=dec_enc_attn_mask,
+                slf_attn_causal=True)
 
-        #- Forward
-        dec_output = self.tgt_word_emb(tgt_seq) + self.position_enc(tgt_pos)
+        return dec_output
+
+    def _forward_debug(self, dec_input, enc_output, masks):
+        ''' Forward pass that also collects the self and encoder attention weights '''
+        dec_slf_attn_list, dec_enc_attn_list = [], []
+        non_pad_mask, slf_attn_mask, dec_enc_attn_mask = masks
+        dec_output = dec_input
 
         for dec_layer in self.layer_stack:
             dec_output, dec_slf_attn, dec_enc_attn = dec_layer(
                 dec_output, enc_output,
                 non_pad_mask=non_pad_mask,
                 slf_attn_mask=slf_attn_mask,
-                dec_enc_attn_mask=dec_enc_attn_mask)
-
-            if return_attns:
-                dec_slf_attn_list += [dec_slf_attn]
-                dec_enc_attn_list += [dec_enc_attn]
+                dec_enc_attn_mask=dec_enc_attn_mask,
+                need_weights=True)
+            dec_slf_attn_list += [dec_slf_attn]
+            dec_enc_attn_list += [dec_enc_attn]
 
-        if return_attns:
-            return dec_output, dec_slf_attn_list, dec_enc_attn_list
-        return dec_output,
+        return dec_output, dec_slf_attn_list, dec_enc_attn_list
 
 class Seq2Seq(nn.Module):
     ''' A sequence to sequence model with attention mechanism. '''
@@ -211,15 +308,19 @@ class Seq2Seq(nn.Module):
             tgt_emb_prj_weight_sharing=True,
             emb_src_tgt_weight_sharing=True,
             mmi_factor=0.0,
-            src_emb_file='', tgt_emb_file=''):
+            src_emb_file='', tgt_emb_file='', freeze_emb=False,
+            compile_modules=False):
 
         super().__init__()
 
+        #- Encoder and decoder share a single position table
+        position_enc = PositionEncoding(len_max_seq + 1, d_word_vec)
+
         self.encoder = Encoder(
             n_src_vocab=n_src_vocab, len_max_seq=len_max_seq,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
             n_layers=n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
-            dropout=dropout, emb_file=src_emb_file)
+            dropout=dropout, emb_file=src_emb_file, freeze_emb=freeze_emb, position_enc=position_enc)
 
         self.session = Session(d_model, d_hidden, dropout)
 
@@ -227,7 +328,7 @@ class Seq2Seq(nn.Module):
             n_tgt_vocab=n_tgt_vocab, len_max_seq=len_max_seq,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
             n_layers=n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
-            dropout=dropout, emb_file=tgt_emb_file)
+            dropout=dropout, emb_file=tgt_emb_file, freeze_emb=freeze_emb, position_enc=position_enc)
 
         self.tgt_word_prj = nn.Linear(d_model, n_tgt_vocab, bias=False)
         nn.init.xavier_normal_(self.tgt_word_prj.weight)
@@ -252,21 +353,41 @@ class Seq2Seq(nn.Module):
         #- Set MMI factor (mmi_factor=0.0 for MLE)
         self.mmi_factor = mmi_factor
 
-    def forward(self, src_seq, src_pos, tgt_seq, tgt_pos):
-        tgt_seq, tgt_pos = tgt_seq[:, :-1], tgt_pos[:, :-1]
-
-        enc_output, *_ = self.encoder(src_seq, src_pos)
-        ses_output, *_ = self.session(enc_output, src_seq)
-        
-        dec_output = None
-        if self.mmi_factor > 0:
-            #- Split forward pass to compute session-infused and session-dry outputs
-            ses_output = torch.cat((ses_output, enc_output), dim=0)
-            new_tgt_seq, new_tgt_pos, new_src_seq = tgt_seq.repeat(2, 1), tgt_pos.repeat(2, 1), src_seq.repeat(2, 1)
-            dec_output, *_ = self.decoder(new_tgt_seq, new_tgt_pos, new_src_seq, ses_output)
-        else:
-            #- Regular forward pass
-            dec_output, *_ = self.decoder(tgt_seq, tgt_pos, src_seq, ses_output)
+        if compile_modules:
+            #- Compile bound methods rather than wrapping the modules, so state_dict keys stay unchanged
+            self.encoder._forward_train = torch.compile(
+                self.encoder._forward_train, dynamic=True, fullgraph=False)
+            self.session.forward = torch.compile(
+                self.session.forward, dynamic=True, fullgraph=False)
+            self.decoder._prepare_input = torch.compile(
+                self.decoder._prepare_input, dynamic=True, fullgraph=False)
+            self.decoder._forward_train = torch.compile(
+                self.decoder._forward_train, dynamic=True, fullgraph=False)
 
-        seq_logit = self.tgt_word_prj(dec_output) * self.x_logit_scale
+    def forward(self, src_seq, src_pos, tgt_seq, tgt_pos):
+        #- Positions may be passed as None to derive them from the sequences
+        tgt_seq = tgt_seq[:, :-1]
+        if tgt_pos is not None:
+            tgt_pos = tgt_pos[:, :-1]
+
+        #- Run encoder, session and decoder in BF16 on GPUs with native support (Ampere and newer)
+        use_amp = src_seq.is_cuda and torch.cuda.get_device_capability(src_seq.device)[0] >= 8
+        with torch.autocast(device_type=src_seq.device.type, dtype=torch.bfloat16, enabled=use_amp):
+            enc_output, *_ = self.encoder(src_seq, src_pos)
+            ses_output, *_ = self.session(enc_output, src_seq)
+
+            dec_output = None
+            if self.mmi_factor > 0:
+                #- Split forward pass to compute session-infused and session-dry outputs,
+                #- sharing the target embedding and masks between both passes
+                dec_input, masks = self.decoder._prepare_input(tgt_seq, tgt_pos, src_seq)
+                ses_dec_output, *_ = self.decoder._forward_from_emb(dec_input, ses_output, masks)
+                enc_dec_output, *_ = self.decoder._forward_from_emb(dec_input, enc_output, masks)
+                dec_output = torch.cat((ses_dec_output, enc_dec_output), dim=0)
+            else:
+                #- Regular forward pass
+                dec_output, *_ = self.decoder(tgt_seq, tgt_pos, src_seq, ses_output)
+
+        #- Keep the logits in FP32 for the loss, scaling the d_model-sized input instead of the vocab-sized output
+        seq_logit = F.linear(dec_output.float() * self.x_logit_scale, self.tgt_word_prj.weight)
         return seq_logit.view(-1, seq_logit.size(2))
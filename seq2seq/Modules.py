@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 
@@ -8,21 +9,34 @@ class ScaledDotProductAttention(nn.Module):
 
     def __init__(self, temperature, attn_dropout=0.1):
         super().__init__()
-        self.temperature = temperature
+        self.temperature = float(temperature)
         self.dropout = nn.Dropout(attn_dropout)
-        self.softmax = nn.Softmax(dim=2)
+        self.softmax = nn.Softmax(dim=-1)
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, is_causal=False, need_weights=False):
 
-        attn = torch.bmm(q, k.transpose(1, 2))
+        if not need_weights:
+            #- Fused kernel, never materializes the attention matrix (mask marks positions to attend)
+            output = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=None if mask is None else ~mask,
+                dropout_p=self.dropout.p if self.training else 0.,
+                is_causal=is_causal, scale=1. / self.temperature)
+            return output, None
+
+        attn = torch.matmul(q, k.transpose(-2, -1))
         attn = attn / self.temperature
 
+        if is_causal:
+            len_q, len_k = attn.size(-2), attn.size(-1)
+            causal_mask = torch.ones((len_q, len_k), device=attn.device, dtype=torch.bool).triu(1)
+            attn = attn.masked_fill(causal_mask, -np.inf)
+
         if mask is not None:
             attn = attn.masked_fill(mask, -np.inf)
 
         attn = self.softmax(attn)
         attn = self.dropout(attn)
-        output = torch.bmm(attn, v)
+        output = torch.matmul(attn, v)
 
         return output, attn
 
@@ -38,8 +52,8 @@ class MultiplicativeAttention(nn.Module):
         attn_vec = self.attn_weight(ses_hidden).unsqueeze(-1)
 
         #- Compute attention distribution and fill pad values with 0
-        attn_distr = torch.bmm(enc_output, attn_vec).repeat(1, 1, enc_output.size(-1))
-        attn_distr[~non_pad_mask] = float('-inf')
+        attn_distr = torch.bmm(enc_output, attn_vec)  # b x l x 1
+        attn_distr = attn_distr.masked_fill(~non_pad_mask, float('-inf'))
         attn_distr = self.softmax(attn_distr)
         
         return attn_distr
@@ -56,8 +70,8 @@ class DotProductAttention(nn.Module):
         attn_vec = ses_hidden.unsqueeze(-1)
 
         #- Compute attention distribution and fill pad values with 0
-        attn_distr = torch.bmm(enc_output, attn_vec).repeat(1, 1, enc_output.size(-1))
-        attn_distr[~non_pad_mask] = float('-inf')
+        attn_distr = torch.bmm(enc_output, attn_vec)  # b x l x 1
+        attn_distr = attn_distr.masked_fill(~non_pad_mask, float('-inf'))
         attn_distr = self.softmax(attn_distr)
 
         return attn_distr
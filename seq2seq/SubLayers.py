@@ -32,7 +32,7 @@ class MultiHeadAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
 
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, is_causal=False, need_weights=False):
 
         d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
 
@@ -46,15 +46,16 @@ class MultiHeadAttention(nn.Module):
         k = self.w_ks(k).view(sz_b, len_k, n_head, d_k)
         v = self.w_vs(v).view(sz_b, len_v, n_head, d_v)
 
-        q = q.permute(2, 0, 1, 3).contiguous().view(-1, len_q, d_k) # (n*b) x lq x dk
-        k = k.permute(2, 0, 1, 3).contiguous().view(-1, len_k, d_k) # (n*b) x lk x dk
-        v = v.permute(2, 0, 1, 3).contiguous().view(-1, len_v, d_v) # (n*b) x lv x dv
+        q = q.transpose(1, 2) # b x n x lq x dk
+        k = k.transpose(1, 2) # b x n x lk x dk
+        v = v.transpose(1, 2) # b x n x lv x dv
 
-        mask = mask.repeat(n_head, 1, 1) # (n*b) x .. x ..
-        output, attn = self.attention(q, k, v, mask=mask)
+        if mask is not None:
+            mask = mask.unsqueeze(1) # b x 1 x .. x .., broadcast over heads
+        output, attn = self.attention(
+            q, k, v, mask=mask, is_causal=is_causal, need_weights=need_weights)
 
-        output = output.view(n_head, sz_b, len_q, d_v)
-        output = output.permute(1, 2, 0, 3).contiguous().view(sz_b, len_q, -1) # b x lq x (n*dv)
+        output = output.transpose(1, 2).contiguous().view(sz_b, len_q, -1) # b x lq x (n*dv)
 
         output = self.dropout(self.fc(output))
         output = self.layer_norm(output + residual)
@@ -30,8 +30,9 @@ def train_epoch(model, training_data, optimizer, device, mmi_factor, smoothing=T
             training_data, mininterval=2,
             desc='  - (Training)   ', leave=False):
 
-        #- Prepare data
-        src_seq, src_pos, tgt_seq, tgt_pos = map(lambda x: x.to(device), batch)
+        #- Prepare data (positions are derived on device by the model)
+        src_seq, _, tgt_seq, _ = batch
+        src_seq, tgt_seq = src_seq.to(device), tgt_seq.to(device)
         batch_size, n_steps, _ = src_seq.size()
 
         #- Clip the target_seq for the BOS token
@@ -43,8 +44,8 @@ def train_epoch(model, training_data, optimizer, device, mmi_factor, smoothing=T
         preds = []
         for i in range(n_steps):
             pred = model(
-                src_seq[:, i, :].squeeze(1), src_pos[:, i, :].squeeze(1),
-                tgt_seq[:, i, :].squeeze(1), tgt_pos[:, i, :].squeeze(1))
+                src_seq[:, i, :].squeeze(1), None,
+                tgt_seq[:, i, :].squeeze(1), None)
             preds.append(pred)
 
         #- Backward (use total loss)
@@ -83,9 +84,10 @@ def eval_epoch(model, validation_data, device, mmi_factor):
                 validation_data, mininterval=2,
                 desc='  - (Validation) ', leave=False):
 
-            #- Prepare data
-            src_seq, src_pos, tgt_seq, tgt_pos = map(lambda x: x.to(device), batch)
-            batch_size, n_steps, _ = src_pos.size()
+            #- Prepare data (positions are derived on device by the model)
+            src_seq, _, tgt_seq, _ = batch
+            src_seq, tgt_seq = src_seq.to(device), tgt_seq.to(device)
+            batch_size, n_steps, _ = src_seq.size()
             gold = tgt_seq[:, :, 1:]
 
             #- Reset LSTM hidden states
@@ -95,8 +97,8 @@ def eval_epoch(model, validation_data, device, mmi_factor):
             preds = []
             for i in range(n_steps):
                 pred = model(
-                    src_seq[:, i, :].squeeze(1), src_pos[:, i, :].squeeze(1),
-                    tgt_seq[:, i, :].squeeze(1), tgt_pos[:, i, :].squeeze(1))
+                    src_seq[:, i, :].squeeze(1), None,
+                    tgt_seq[:, i, :].squeeze(1), None)
                 preds.append(pred)
 
             #- Accumulate loss and accuracy
@@ -197,6 +199,7 @@ def main():
 
     parser.add_argument('-src_emb_file', type=str, default='')
     parser.add_argument('-tgt_emb_file', type=str, default='')
+    parser.add_argument('-freeze_emb', action='store_true')
 
     parser.add_argument('-d_word_vec', type=int, default=300)
     parser.add_argument('-d_hidden', type=int, default=512)
@@ -219,6 +222,7 @@ def main():
     parser.add_argument('-load_model', default=None)
 
     parser.add_argument('-no_cuda', action='store_true')
+    parser.add_argument('-compile', action='store_true')
     parser.add_argument('-label_smoothing', action='store_true')
     parser.add_argument('-mmi_factor', type=float, default=0.0)
 
@@ -262,7 +266,9 @@ def main():
         dropout=opt.dropout,
         mmi_factor=opt.mmi_factor,
         src_emb_file=opt.src_emb_file,
-        tgt_emb_file=opt.tgt_emb_file).to(device)
+        tgt_emb_file=opt.tgt_emb_file,
+        freeze_emb=opt.freeze_emb,
+        compile_modules=opt.compile).to(device)
 
     #- Output total number of parameters
     model_parameters = filter(lambda p: p.requires_grad, seq2seq.parameters())
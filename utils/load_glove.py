@@ -1,25 +1,65 @@
 ''' This script builds GloVe word-embedding table '''
+import os
+import hashlib
+import multiprocessing
 import numpy as np
 import pickle
 import argparse
-from tqdm import tqdm
 
 from seq2seq import Constants
 
 
+def parse_glove_lines(lines, vocab):
+    ''' Parses raw GloVe lines, keeping only words in vocab '''
+    word2emb = {}
+    for line in lines:
+        #- Only decode the word, and parse the floats of kept lines in numpy
+        word, _, rest = line.partition(b' ')
+        word = word.decode('utf-8', 'ignore')
+        if word not in vocab:
+            continue
+        word2emb[word] = np.fromstring(rest, sep=' ', dtype=np.float32)
+
+    return word2emb
+
 def load_glove(glove_path, vocab=set([])):
     ''' Loads GloVe embeddings '''
+    with open(glove_path, 'rb') as f:
+        return parse_glove_lines(f, vocab)
+
+def _read_glove_chunk(glove_path, start, end):
+    ''' Yields the lines starting within [start, end) of the GloVe file '''
+    with open(glove_path, 'rb') as f:
+        #- Skip to the first line starting at or after start
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+def _load_glove_chunk(glove_path, start, end, vocab):
+    return parse_glove_lines(_read_glove_chunk(glove_path, start, end), vocab)
+
+def load_glove_parallel(glove_path, vocab=set([]), n_workers=os.cpu_count()):
+    ''' Loads GloVe embeddings, parsing byte ranges of the file in worker processes '''
+    file_size = os.path.getsize(glove_path)
+    bounds = [file_size * i // n_workers for i in range(n_workers + 1)]
+    chunks = [(glove_path, start, end, vocab) for start, end in zip(bounds[:-1], bounds[1:])]
+
     word2emb = {}
-    with open(glove_path,'r', encoding="utf-8") as f:
-        for line in tqdm(f):
-            split_line = line.split()
-            word = split_line[0]
-            if word in vocab:
-                word2emb[word] = np.array([float(val) for val in split_line[1:]])
+    with multiprocessing.Pool(n_workers) as pool:
+        for chunk_word2emb in pool.starmap(_load_glove_chunk, chunks):
+            word2emb.update(chunk_word2emb)
 
     return word2emb
 
-def create_glove_emb_table(word2idx, split_name, glove_path='data/glove/glove.6B.300d.txt', glove_size=300):
+def create_glove_emb_table(
+        word2idx, split_name, glove_path='data/glove/glove.6B.300d.txt', glove_size=300, n_workers=1):
     ''' Creates GloVe embedding table and changes word2idx '''
     #- Disregard special tokens when looking for glove pairs
     word2idx.pop(Constants.PAD_WORD, None)
@@ -27,9 +67,26 @@ def create_glove_emb_table(word2idx, split_name, glove_path='data/glove/glove.6B
     word2idx.pop(Constants.BOS_WORD, None)
     word2idx.pop(Constants.EOS_WORD, None)
 
+    #- Reuse the pre-filtered table if this vocab was already looked up in this GloVe file
+    #- Sibling GloVe files share an mtime, so the file name and width are part of the key
+    cache_key = hashlib.blake2b((
+        repr(sorted(word2idx.keys())) + str(os.path.getmtime(glove_path)) +
+        os.path.basename(glove_path) + str(glove_size)).encode('utf-8')).hexdigest()[:16]
+    cache_prefix = os.path.join(os.path.dirname(glove_path), 'cache_{}_{}'.format(split_name, cache_key))
+    if os.path.exists(cache_prefix + '.npy') and os.path.exists(cache_prefix + '.pkl'):
+        print("[Info] Load cached GloVe table from {}.".format(cache_prefix))
+        with open(cache_prefix + '.pkl', 'rb') as f:
+            word2idx = pickle.load(f)
+        emb_table = np.load(cache_prefix + '.npy', mmap_mode='r')
+        print('[Info] Final {} vocabulary size: {}'.format(split_name, len(word2idx)))
+        return word2idx, emb_table
+
     #- Load GloVe model
     print("[Info] Load GloVe model.")
-    word2emb = load_glove(glove_path, set(word2idx.keys()))
+    if n_workers > 1:
+        word2emb = load_glove_parallel(glove_path, set(word2idx.keys()), n_workers)
+    else:
+        word2emb = load_glove(glove_path, set(word2idx.keys()))
 
     #- Create embedding table and new vocab, randomly initialize special tokens
     word2idx = {
@@ -38,15 +95,20 @@ def create_glove_emb_table(word2idx, split_name, glove_path='data/glove/glove.6B
         Constants.PAD_WORD: Constants.PAD,
         Constants.UNK_WORD: Constants.UNK}
 
-    emb_table = np.zeros(shape=(len(word2emb) + 4, glove_size))
-    emb_table[Constants.PAD] = np.random.randn(glove_size)
-    emb_table[Constants.UNK] = np.random.randn(glove_size)
-    emb_table[Constants.BOS] = np.random.randn(glove_size)
-    emb_table[Constants.EOS] = np.random.randn(glove_size)
-    for idx, (word, emb) in enumerate(word2emb.items(), 4):
-        emb_table[idx] = emb
+    emb_table = np.empty((len(word2emb) + 4, glove_size), dtype=np.float32)
+    emb_table[Constants.PAD] = np.random.randn(glove_size).astype(np.float32)
+    emb_table[Constants.UNK] = np.random.randn(glove_size).astype(np.float32)
+    emb_table[Constants.BOS] = np.random.randn(glove_size).astype(np.float32)
+    emb_table[Constants.EOS] = np.random.randn(glove_size).astype(np.float32)
+    if word2emb:
+        emb_table[4:] = np.stack(list(word2emb.values()))
+    for idx, word in enumerate(word2emb, 4):
         word2idx[word] = idx
 
+    np.save(cache_prefix + '.npy', emb_table)
+    with open(cache_prefix + '.pkl', 'wb') as f:
+        pickle.dump(word2idx, f)
+
     print('[Info] Final {} vocabulary size: {}'.format(split_name, len(word2idx)))
 
     return word2idx, emb_table